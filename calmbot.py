@@ -1,53 +1,39 @@
 import sqlite3
 import os
-import json
-import aiohttp
+import orjson
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from telegram.error import TimedOut, RetryAfter
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 import asyncio
 import logging
+import threading
+import atexit
+import time
+import hashlib
+import random
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
-from textblob import TextBlob
-from flask import Flask, request
-
-# Setup Flask app for webhook
-app = Flask(__name__)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 RENDER_EXTERNAL_HOSTNAME = os.getenv("RENDER_EXTERNAL_HOSTNAME")
+TG_SECRET = os.getenv("TG_SECRET")
 
 # Log environment variables for debugging
-logging.info(f"TELEGRAM_TOKEN: {'Set' if TELEGRAM_TOKEN else 'Not set'}")
-logging.info(f"GOOGLE_API_KEY: {'Set' if GOOGLE_API_KEY else 'Not set'}")
-logging.info(f"RENDER_EXTERNAL_HOSTNAME: {RENDER_EXTERNAL_HOSTNAME or 'Not set'}")
-logging.info(f"PORT: {os.getenv('PORT', '10000')}")
-
-# Validate TELEGRAM_TOKEN
-async def validate_token():
-    if not TELEGRAM_TOKEN:
-        logging.error("TELEGRAM_TOKEN is not set")
-        return False
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getMe") as response:
-                data = await response.json()
-                logging.info(f"Token validation response: {data}")
-                return data.get("ok", False)
-        except Exception as e:
-            logging.error(f"Token validation failed: {str(e)}")
-            return False
-
-# Configure Gemini API
-genai.configure(api_key=GOOGLE_API_KEY)
-gemini_model = genai.GenerativeModel('gemini-1.5-flash')
+logger.info("TELEGRAM_TOKEN: %s", 'Set' if TELEGRAM_TOKEN else 'Not set')
+logger.info("GOOGLE_API_KEY: %s", 'Set' if GOOGLE_API_KEY else 'Not set')
+logger.info("RENDER_EXTERNAL_HOSTNAME: %s", RENDER_EXTERNAL_HOSTNAME or 'Not set')
+logger.info("TG_SECRET: %s", 'Set' if TG_SECRET else 'Not set')
+logger.info("PORT: %s", os.getenv('PORT', '10000'))
 
 # System prompt
 SYSTEM_PROMPT = """
@@ -60,45 +46,122 @@ You are CalmBot, an AI companion designed to help users heal from emotional dist
 - If the input is vague, ask a gentle follow-up question to clarify their needs.
 """
 
+# Configure Gemini API; the system prompt is sent as a system instruction
+# rather than being repeated in every request's content
+genai.configure(api_key=GOOGLE_API_KEY)
+gemini_model = genai.GenerativeModel('gemini-1.5-flash', system_instruction=SYSTEM_PROMPT)
+
 # Load model_log.json
 try:
-    with open("model_log.json", "r", encoding="utf-8") as f:
-        DATASET = json.load(f)
-    RESPONSE_MAP = {item["input"].lower(): item["output"] for item in DATASET}
+    with open("model_log.json", "rb") as f:
+        DATASET = orjson.loads(f.read())
+    RESPONSE_MAP = {item["input"].strip().lower(): item["output"] for item in DATASET}
 except Exception as e:
-    logging.error(f"Error loading model_log.json: {e}")
+    logger.error("Error loading model_log.json: %s", e)
     RESPONSE_MAP = {}
+_RESPONSE_GET = RESPONSE_MAP.get
+
+# Load sentiment_lexicon.json (word -> polarity score) for the offline fallback
+try:
+    with open("sentiment_lexicon.json", "rb") as f:
+        LEXICON = orjson.loads(f.read())
+except Exception as e:
+    logger.error("Error loading sentiment_lexicon.json: %s", e)
+    LEXICON = {}
 
-# Initialize unknown_inputs.json
-UNKNOWN_INPUTS_FILE = "unknown_inputs.json"
-if not os.path.exists(UNKNOWN_INPUTS_FILE):
-    with open(UNKNOWN_INPUTS_FILE, "w", encoding="utf-8") as f:
-        json.dump([], f)
+def sentiment_score(text):
+    return sum(LEXICON.get(word.strip(".,!?;:'\"()"), 0) for word in text.lower().split())
+
+# Unknown inputs are appended to a JSON Lines file, one record per line
+UNKNOWN_INPUTS_FILE = "unknown_inputs.jsonl"
+UNKNOWN_BUFFER = deque()
+UNKNOWN_LOCK = threading.Lock()
+UNKNOWN_FLUSHER = None
+UNKNOWN_BATCH_SIZE = 50
+UNKNOWN_FLUSH_INTERVAL = 1.0  # seconds
 
 # SQLite database setup
+DB_FILE = "mood_tracker.db"
+DB_LOCK = threading.Lock()
+DB_CONNECTIONS = []
+_tls = threading.local()
+# SQLite allows a single writer, so all mood inserts run on one dedicated
+# thread and the event loop never waits on a commit.
+DB_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+MOOD_QUEUE = asyncio.Queue()
+MOOD_FLUSHER = None
+MOOD_BATCH_SIZE = 100
+MOOD_FLUSH_INTERVAL = 0.2  # seconds
+# Nothing reads mood history yet, so the (user_id, timestamp) index is opt-in
+# to keep inserts as cheap as possible until such queries exist.
+MOOD_HISTORY_INDEX = os.getenv("MOOD_HISTORY_INDEX", "0") == "1"
+
+# Return this thread's connection, opening and tuning it on first use
+def get_conn():
+    conn = getattr(_tls, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        _tls.conn = conn
+        with DB_LOCK:
+            DB_CONNECTIONS.append(conn)
+    return conn
+
 def init_db():
-    conn = sqlite3.connect("mood_tracker.db")
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS responses
+    conn = get_conn()
+    conn.execute('''CREATE TABLE IF NOT EXISTS responses
                  (user_id INTEGER, timestamp TEXT, mood TEXT, message TEXT)''')
-    conn.commit()
-    conn.close()
+    if MOOD_HISTORY_INDEX:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_user_time ON responses(user_id, timestamp DESC)")
+    atexit.register(close_db)
+
+def close_db():
+    with DB_LOCK:
+        while DB_CONNECTIONS:
+            conn = DB_CONNECTIONS.pop()
+            try:
+                conn.execute("PRAGMA optimize")
+            except Exception as e:
+                logger.error("PRAGMA optimize failed: %s", e)
+            conn.close()
+
+# Append buffered unknown inputs to the log file
+def flush_unknown_inputs():
+    with UNKNOWN_LOCK:
+        records = []
+        while UNKNOWN_BUFFER:
+            records.append(UNKNOWN_BUFFER.popleft())
+        if not records:
+            return
+        try:
+            with open(UNKNOWN_INPUTS_FILE, "ab") as f:
+                f.write(b"".join(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE) for record in records))
+        except Exception as e:
+            logger.error("Failed to write %s unknown inputs: %s", len(records), e)
+
+async def unknown_input_flusher():
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            await asyncio.sleep(UNKNOWN_FLUSH_INTERVAL)
+            await loop.run_in_executor(None, flush_unknown_inputs)
+    finally:
+        flush_unknown_inputs()
 
 # Log unknown input
 def log_unknown_input(user_id, user_message, is_followup=False):
-    try:
-        with open(UNKNOWN_INPUTS_FILE, "r", encoding="utf-8") as f:
-            unknown_inputs = json.load(f)
-    except:
-        unknown_inputs = []
-    unknown_inputs.append({
+    UNKNOWN_BUFFER.append({
         "user_id": user_id,
-        "timestamp": str(asyncio.get_event_loop().time()),
+        "timestamp": str(time.time()),
         "input": user_message,
         "is_followup": is_followup
     })
-    with open(UNKNOWN_INPUTS_FILE, "w", encoding="utf-8") as f:
-        json.dump(unknown_inputs, f, indent=2, ensure_ascii=False)
+    if len(UNKNOWN_BUFFER) >= UNKNOWN_BATCH_SIZE:
+        asyncio.get_running_loop().run_in_executor(None, flush_unknown_inputs)
 
 # Button responses
 BUTTON_RESPONSES = {
@@ -108,234 +171,408 @@ BUTTON_RESPONSES = {
     "anxiety": "Anxiety can feel like a tight knot, but you’re stronger than the worries you carry. Try a quick grounding exercise: name 5 things you see around you. I’m here for you. Want to talk it out? Use /chat to share what’s weighing on you."
 }
 
+# Inline keyboards, built once and shared by all handlers
+MOOD_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("😊 Happy", callback_data="happiness"),
+     InlineKeyboardButton("😢 Sad", callback_data="sadness")],
+    [InlineKeyboardButton("😡 Angry", callback_data="anger"),
+     InlineKeyboardButton("😟 Anxious", callback_data="anxiety")]
+])
+POST_MOOD_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Chat with CalmBot", callback_data="chat_after_mood"),
+     InlineKeyboardButton("Change Response", callback_data="change_response")]
+])
+
+# Reply arguments for the static messages, built once and unpacked into send()
+START_REPLY = {
+    "text": "Hi! I’m CalmBot, your emotional support companion. Share how you feel, pick an emotion below, or use /chat to talk freely!",
+    "reply_markup": MOOD_KEYBOARD,
+}
+CHAT_REPLY = {"text": "Let’s chat! I’m here to listen and support you. What’s on your mind?"}
+CHAT_AFTER_MOOD_REPLY = {"text": "Great, let’s dive deeper! What’s on your mind about how you’re feeling?"}
+CHANGE_RESPONSE_REPLY = {"text": "No worries! How are you feeling now?", "reply_markup": MOOD_KEYBOARD}
+BUTTON_REPLIES = {
+    mood: {"text": text, "reply_markup": POST_MOOD_KEYBOARD}
+    for mood, text in BUTTON_RESPONSES.items()
+}
+
+# Gemini response cache (exact prompt match, LRU with TTL)
+GEMINI_CACHE = OrderedDict()
+GEMINI_CACHE_SIZE = 2048
+GEMINI_CACHE_TTL = 1800  # seconds
+GEMINI_CACHE_LOCK = threading.Lock()
+
+def gemini_cache_key(prompt):
+    return hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).digest()
+
+def gemini_cache_get(key):
+    with GEMINI_CACHE_LOCK:
+        entry = GEMINI_CACHE.get(key)
+        if entry is None:
+            return None
+        expiry, text = entry
+        if time.monotonic() >= expiry:
+            del GEMINI_CACHE[key]
+            return None
+        GEMINI_CACHE.move_to_end(key)
+        return text
+
+def gemini_cache_put(key, text):
+    with GEMINI_CACHE_LOCK:
+        GEMINI_CACHE[key] = (time.monotonic() + GEMINI_CACHE_TTL, text)
+        GEMINI_CACHE.move_to_end(key)
+        while len(GEMINI_CACHE) > GEMINI_CACHE_SIZE:
+            GEMINI_CACHE.popitem(last=False)
+
+# Bound concurrent Gemini calls and coalesce identical in-flight prompts
+GEMINI_CONCURRENCY = 8
+GEMINI_SEMAPHORE = asyncio.Semaphore(GEMINI_CONCURRENCY)
+GEMINI_LOCKS = defaultdict(asyncio.Lock)
+
+# Conversation history: the last HISTORY_TURNS (user, bot) pairs per user
+HISTORY_TURNS = 6
+
+def new_history(*turns):
+    return deque(turns, maxlen=HISTORY_TURNS)
+
+def get_history(context):
+    history = context.user_data.get("history")
+    if history is None:
+        history = context.user_data["history"] = new_history()
+    return history
+
+def format_history(history):
+    return "\n".join(f"User: {user} | Bot: {bot}" for user, bot in history)
+
 # Generate Gemini response
-def generate_gemini_response(user_message, prev_response=None, conversation_history=""):
+async def generate_gemini_response(user_message, prev_response=None, history=()):
     try:
-        full_prompt = f"{SYSTEM_PROMPT}\n\nConversation history: {conversation_history}\n\nPrevious bot response: {prev_response or 'None'}\n\nUser input: {user_message}\n\nRespond appropriately."
-        response = gemini_model.generate_content(full_prompt)
-        return response.text.strip()
+        conversation_history = format_history(history)
+        full_prompt = f"History: {conversation_history}\nPrev: {prev_response or 'None'}\nUser: {user_message}"
+        key = gemini_cache_key(full_prompt)
+        cached = gemini_cache_get(key)
+        if cached is not None:
+            return cached
+        try:
+            async with GEMINI_LOCKS[key]:
+                cached = gemini_cache_get(key)
+                if cached is not None:
+                    return cached
+                async with GEMINI_SEMAPHORE:
+                    response = await asyncio.to_thread(gemini_model.generate_content, full_prompt)
+                text = response.text.strip()
+                gemini_cache_put(key, text)
+                return text
+        finally:
+            GEMINI_LOCKS.pop(key, None)
     except Exception as e:
-        logging.error(f"Gemini API error: {e}")
-        analysis = TextBlob(user_message)
-        sentiment = 'positive' if analysis.sentiment.polarity > 0 else 'negative' if analysis.sentiment.polarity < 0 else 'neutral'
+        logger.error("Gemini API error: %s", e)
+        score = sentiment_score(user_message)
+        sentiment = 'positive' if score > 0 else 'negative' if score < 0 else 'neutral'
         return f"I hear you. Your message feels {sentiment}. Want to explore this further? Try sharing more or use /chat for support."
 
+# Inputs that are answered without calling Gemini
+MAX_MESSAGE_LENGTH = 4000
+EMPTY_MESSAGE_REPLY = "I'm here whenever you want to share — try typing how you feel."
+LONG_MESSAGE_REPLY = "That's a lot to carry, and I want to hear it. Could you share it in a few shorter messages?"
+
 # Map input to response
-def get_response(user_id, user_message, prev_response=None, context=None):
-    user_message = user_message.lower().strip()
-    if user_message in RESPONSE_MAP:
+async def get_response(user_id, user_message, prev_response=None, context=None):
+    user_message = user_message.strip().lower()
+    if not user_message:
+        return EMPTY_MESSAGE_REPLY
+    if len(user_message) > MAX_MESSAGE_LENGTH:
+        return LONG_MESSAGE_REPLY
+    hit = _RESPONSE_GET(user_message)
+    if hit is not None:
         if context:
             context.user_data["awaiting_followup"] = False
-        return RESPONSE_MAP[user_message]
+        return hit
     if user_message == "yes" and prev_response:
         if context:
             context.user_data["awaiting_followup"] = False
-        return generate_gemini_response(
+        return await generate_gemini_response(
             user_message,
             prev_response,
-            context.user_data.get("conversation_history", "")
+            get_history(context)
         )
     if context and context.user_data.get("awaiting_followup", False):
         log_unknown_input(user_id, user_message, is_followup=True)
         context.user_data["awaiting_followup"] = False
-        return generate_gemini_response(
+        return await generate_gemini_response(
             user_message,
             prev_response,
-            context.user_data.get("conversation_history", "")
+            get_history(context)
         )
     log_unknown_input(user_id, user_message, is_followup=False)
     if context:
         context.user_data["awaiting_followup"] = True
-    return generate_gemini_response(
+    return await generate_gemini_response(
         user_message,
         prev_response,
-        context.user_data.get("conversation_history", "")
+        get_history(context)
     )
 
+# Write a batch of mood rows in a single transaction
+def write_moods(rows):
+    conn = get_conn()
+    conn.execute("BEGIN")
+    try:
+        conn.executemany("INSERT INTO responses (user_id, timestamp, mood, message) VALUES (?, datetime('now'), ?, ?)",
+                         rows)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def flush_moods(rows):
+    try:
+        write_moods(rows)
+    except Exception as e:
+        logger.error("Failed to write %s mood rows: %s", len(rows), e)
+
+# Drain the mood queue, committing up to MOOD_BATCH_SIZE rows or every MOOD_FLUSH_INTERVAL
+async def mood_flusher():
+    loop = asyncio.get_running_loop()
+    rows = []
+    try:
+        while True:
+            rows.append(await MOOD_QUEUE.get())
+            deadline = loop.time() + MOOD_FLUSH_INTERVAL
+            while len(rows) < MOOD_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(MOOD_QUEUE.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch, rows = rows, []
+            await loop.run_in_executor(DB_WRITER, flush_moods, batch)
+    finally:
+        # Write whatever is still pending when the loop shuts the flusher down
+        while not MOOD_QUEUE.empty():
+            rows.append(MOOD_QUEUE.get_nowait())
+        if rows:
+            flush_moods(rows)
+
 # Log mood to database
 def log_mood(user_id, mood, message):
-    conn = sqlite3.connect("mood_tracker.db")
-    c = conn.cursor()
-    c.execute("INSERT INTO responses (user_id, timestamp, mood, message) VALUES (?, datetime('now'), ?, ?)",
-              (user_id, mood, message))
-    conn.commit()
-    conn.close()
+    MOOD_QUEUE.put_nowait((user_id, mood, message))
+
+# Proactive rate limiting for outgoing messages (Telegram allows ~30/s overall, ~1/s per chat)
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def is_full(self):
+        if self.lock.locked():
+            return False
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+GLOBAL_BUCKET = TokenBucket(rate=30, capacity=30)
+CHAT_BUCKETS = OrderedDict()  # chat_id -> TokenBucket, least recently used first
+
+def chat_bucket(chat_id):
+    bucket = CHAT_BUCKETS.get(chat_id)
+    if bucket is None:
+        bucket = CHAT_BUCKETS[chat_id] = TokenBucket(rate=1, capacity=1)
+    CHAT_BUCKETS.move_to_end(chat_id)
+    # A refilled bucket behaves like a new one, so idle chats can be forgotten
+    while True:
+        oldest_id, oldest = next(iter(CHAT_BUCKETS.items()))
+        if oldest is bucket or not oldest.is_full():
+            break
+        del CHAT_BUCKETS[oldest_id]
+    return bucket
+
+# Failed sends are retried by a background sender instead of inside the handler
+SEND_ATTEMPTS = 3
+RETRY_QUEUE = asyncio.Queue(maxsize=1000)
+RETRY_SENDER = None
+
+def schedule_retry(delay, message, text, attempt, kwargs):
+    if attempt + 1 >= SEND_ATTEMPTS:
+        logger.error("Giving up on message to chat %s after %s attempts", message.chat_id, SEND_ATTEMPTS)
+        return
+    asyncio.get_running_loop().call_later(delay, enqueue_retry, (message, text, attempt + 1, kwargs))
+
+def enqueue_retry(item):
+    try:
+        RETRY_QUEUE.put_nowait(item)
+    except asyncio.QueueFull:
+        logger.warning("Retry queue full, dropping message to chat %s", item[0].chat_id)
+
+async def retry_sender():
+    while True:
+        message, text, attempt, kwargs = await RETRY_QUEUE.get()
+        try:
+            await send(message, text, attempt=attempt, **kwargs)
+        except Exception as e:
+            logger.error("Retry to chat %s failed: %s", message.chat_id, e)
+
+# Send a reply once both the per-chat and global buckets allow it;
+# timeouts and rate limits are handed to the retry sender
+async def send(message, text, attempt=0, **kwargs):
+    await chat_bucket(message.chat_id).acquire()
+    await GLOBAL_BUCKET.acquire()
+    try:
+        return await message.reply_text(text, **kwargs)
+    except RetryAfter as e:
+        logger.warning("Rate limit hit, retrying after %s seconds", e.retry_after)
+        schedule_retry(e.retry_after, message, text, attempt, kwargs)
+    except TimedOut:
+        logger.warning("Timeout on attempt %s/%s", attempt + 1, SEND_ATTEMPTS)
+        schedule_retry(2 ** attempt + random.random(), message, text, attempt, kwargs)
+
+# Drop repeated presses of the same button by the same user
+CALLBACK_DEBOUNCE = 0.5  # seconds
+RECENT_CALLBACKS = OrderedDict()  # user_id -> (callback data, time), oldest first
+
+def is_duplicate_callback(query):
+    now = time.monotonic()
+    while RECENT_CALLBACKS and now - next(iter(RECENT_CALLBACKS.values()))[1] >= CALLBACK_DEBOUNCE:
+        RECENT_CALLBACKS.popitem(last=False)
+    user_id = query.from_user.id
+    last = RECENT_CALLBACKS.pop(user_id, None)
+    RECENT_CALLBACKS[user_id] = (query.data, now)
+    return last is not None and last[0] == query.data
 
 # Telegram bot handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("😊 Happy", callback_data="happiness"),
-         InlineKeyboardButton("😢 Sad", callback_data="sadness")],
-        [InlineKeyboardButton("😡 Angry", callback_data="anger"),
-         InlineKeyboardButton("😟 Anxious", callback_data="anxiety")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     context.user_data["awaiting_followup"] = False
     context.user_data["chat_mode"] = False
-    context.user_data["conversation_history"] = ""
+    context.user_data["history"] = new_history()
     context.user_data["prev_response"] = None
-    await update.message.reply_text(
-        "Hi! I’m CalmBot, your emotional support companion. Share how you feel, pick an emotion below, or use /chat to talk freely!",
-        reply_markup=reply_markup
-    )
+    await send(update.message, **START_REPLY)
 
 async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["chat_mode"] = True
     context.user_data["awaiting_followup"] = False
-    await update.message.reply_text("Let’s chat! I’m here to listen and support you. What’s on your mind?")
+    await send(update.message, **CHAT_REPLY)
 
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     mood = query.data
     user_id = query.from_user.id
-    log_mood(user_id, mood, "Button selection")
-    response = BUTTON_RESPONSES.get(mood, "I'm here to listen. Try /chat to talk freely.")
+    reply = BUTTON_REPLIES[mood]
+    response = reply["text"]
     context.user_data["prev_response"] = response
     context.user_data["awaiting_followup"] = False
-    context.user_data["conversation_history"] = f"User selected mood: {mood} | Bot: {response} "
-    keyboard = [
-        [InlineKeyboardButton("Chat with CalmBot", callback_data="chat_after_mood"),
-         InlineKeyboardButton("Change Response", callback_data="change_response")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.message.reply_text(response, reply_markup=reply_markup)
+    context.user_data["history"] = new_history((f"Selected mood: {mood}", response))
+    await send(query.message, **reply)
+    log_mood(user_id, mood, "Button selection")
 
 async def post_mood_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     action = query.data
     if action == "chat_after_mood":
         context.user_data["chat_mode"] = True
         context.user_data["awaiting_followup"] = False
-        await query.message.reply_text("Great, let’s dive deeper! What’s on your mind about how you’re feeling?")
+        await send(query.message, **CHAT_AFTER_MOOD_REPLY)
     elif action == "change_response":
-        keyboard = [
-            [InlineKeyboardButton("😊 Happy", callback_data="happiness"),
-             InlineKeyboardButton("😢 Sad", callback_data="sadness")],
-            [InlineKeyboardButton("😡 Angry", callback_data="anger"),
-             InlineKeyboardButton("😟 Anxious", callback_data="anxiety")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         context.user_data["awaiting_followup"] = False
-        await query.message.reply_text("No worries! How are you feeling now?", reply_markup=reply_markup)
+        await send(query.message, **CHANGE_RESPONSE_REPLY)
+
+# Route callback queries by their exact data instead of regex patterns
+CALLBACK_HANDLERS = {
+    "happiness": button,
+    "sadness": button,
+    "anger": button,
+    "anxiety": button,
+    "chat_after_mood": post_mood_button,
+    "change_response": post_mood_button,
+}
+
+async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    handler = CALLBACK_HANDLERS.get(query.data)
+    if handler is None or is_duplicate_callback(query):
+        return
+    await handler(update, context)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_message = update.message.text
     user_id = update.message.from_user.id
-    retries = 3
-    for attempt in range(retries):
-        try:
-            if context.user_data.get("chat_mode", False):
-                conversation_history = context.user_data.get("conversation_history", "")
-                prev_response = context.user_data.get("prev_response", None)
-                response = get_response(user_id, user_message, prev_response, context)
-                log_mood(user_id, user_message.lower(), user_message)
-                context.user_data["conversation_history"] = (conversation_history + f"User: {user_message} | Bot: {response} ")[-300:]
-                context.user_data["prev_response"] = response
-            else:
-                response = get_response(user_id, user_message, context=context)
-                log_mood(user_id, user_message.lower(), user_message)
-                context.user_data["prev_response"] = response
-                context.user_data["conversation_history"] = f"User: {user_message} | Bot: {response} "
-            await update.message.reply_text(response)
-            break
-        except TimedOut:
-            logging.warning(f"Timeout on attempt {attempt + 1}/{retries}")
-            if attempt < retries - 1:
-                await asyncio.sleep(2 ** attempt)
-                continue
-            logging.error("Max retries reached for timeout")
-            await update.message.reply_text("Sorry, I’m having trouble connecting. Please try again later.")
-            break
-        except RetryAfter as e:
-            logging.warning(f"Rate limit hit, retrying after {e.retry_after} seconds")
-            await asyncio.sleep(e.retry_after)
-            continue
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-            await update.message.reply_text("An error occurred. Please try again.")
-            break
-
-# Root endpoint for debugging
-@app.route('/')
-def index():
-    return "CalmBot is running! Use Telegram to interact with the bot.", 200
-
-# Webhook test endpoint
-@app.route('/test_webhook', methods=['GET'])
-def test_webhook():
-    webhook_url = f"https://{RENDER_EXTERNAL_HOSTNAME}/webhook"
-    return f"Webhook URL: {webhook_url}. Check logs and Telegram getWebhookInfo.", 200
-
-# Manual webhook setup endpoint
-@app.route('/set_webhook', methods=['GET'])
-def manual_set_webhook():
-    webhook_url = f"https://{RENDER_EXTERNAL_HOSTNAME}/webhook"
     try:
-        asyncio.run(set_webhook())
-        return f"Webhook setup attempted: {webhook_url}. Check logs and getWebhookInfo.", 200
+        if context.user_data.get("chat_mode", False):
+            prev_response = context.user_data.get("prev_response", None)
+            response = await get_response(user_id, user_message, prev_response, context)
+            get_history(context).append((user_message, response))
+            context.user_data["prev_response"] = response
+        else:
+            response = await get_response(user_id, user_message, context=context)
+            context.user_data["prev_response"] = response
+            context.user_data["history"] = new_history((user_message, response))
     except Exception as e:
-        logging.error(f"Manual webhook setup failed: {str(e)}")
-        return f"Failed to set webhook: {str(e)}", 500
-
-# Flask webhook endpoint
-@app.route('/webhook', methods=['POST'])
-def webhook():
+        logger.error("Unexpected error: %s", e)
+        response = "An error occurred. Please try again."
     try:
-        logging.info("Received webhook request")
-        update = Update.de_json(request.get_json(force=True), app_telegram.bot)
-        if update:
-            logging.info(f"Processing update: {update}")
-            asyncio.run(app_telegram.process_update(update))
-            logging.info("Update processed successfully")
-        else:
-            logging.warning("No valid update received")
-        return '', 200
+        await send(update.message, response)
     except Exception as e:
-        logging.error(f"Webhook error: {str(e)}")
-        return '', 500
+        logger.error("Failed to send reply to chat %s: %s", update.message.chat_id, e)
+    log_mood(user_id, user_message.lower(), user_message)
 
-async def set_webhook():
-    webhook_url = f"https://{RENDER_EXTERNAL_HOSTNAME}/webhook"
-    retries = 3
-    for attempt in range(retries):
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/setWebhook?url={webhook_url}") as response:
-                    data = await response.json()
-                    logging.info(f"Webhook setup response: {data}")
-                    if data.get("ok", False):
-                        return
-                    else:
-                        logging.error(f"Webhook setup failed: {data}")
-        except Exception as e:
-            logging.error(f"Webhook setup attempt {attempt + 1}/{retries} failed: {str(e)}")
-        if attempt < retries - 1:
-            await asyncio.sleep(2 ** attempt)
-    logging.error("Failed to set webhook after retries")
+# Background tasks run for the lifetime of the application's event loop
+async def start_background_tasks(application):
+    global MOOD_FLUSHER, UNKNOWN_FLUSHER, RETRY_SENDER
+    MOOD_FLUSHER = asyncio.create_task(mood_flusher())
+    UNKNOWN_FLUSHER = asyncio.create_task(unknown_input_flusher())
+    RETRY_SENDER = asyncio.create_task(retry_sender())
+
+# Flush pending mood rows and unknown inputs before the loop is closed
+async def stop_background_tasks(application):
+    for task in (MOOD_FLUSHER, UNKNOWN_FLUSHER, RETRY_SENDER):
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
 
 # Initialize Telegram app
 if not TELEGRAM_TOKEN:
-    logging.error("Cannot initialize bot: TELEGRAM_TOKEN is not set")
+    logger.error("Cannot initialize bot: TELEGRAM_TOKEN is not set")
     app_telegram = None
 else:
-    app_telegram = Application.builder().token(TELEGRAM_TOKEN).updater(None).build()
+    app_telegram = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .request(HTTPXRequest(connection_pool_size=64, connect_timeout=5, read_timeout=10, pool_timeout=2))
+        .concurrent_updates(256)
+        .post_init(start_background_tasks)
+        .post_shutdown(stop_background_tasks)
+        .build()
+    )
     app_telegram.add_handler(CommandHandler("start", start))
     app_telegram.add_handler(CommandHandler("chat", chat))
-    app_telegram.add_handler(CallbackQueryHandler(button, pattern='^(happiness|sadness|anger|anxiety)$'))
-    app_telegram.add_handler(CallbackQueryHandler(post_mood_button, pattern='^(chat_after_mood|change_response)$'))
+    app_telegram.add_handler(CallbackQueryHandler(dispatch_callback))
     app_telegram.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
 if __name__ == "__main__":
     init_db()
-    if TELEGRAM_TOKEN and app_telegram:
-        # Validate token and initialize app
-        if asyncio.run(validate_token()):
-            asyncio.run(app_telegram.initialize())
-            asyncio.run(app_telegram.start())
-            asyncio.run(set_webhook())
-        else:
-            logging.error("Bot startup aborted due to invalid TELEGRAM_TOKEN")
-    # Run Flask app
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 10000)))
+    if app_telegram:
+        # PTB's webhook server calls setWebhook on startup and validates the token via getMe
+        app_telegram.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", 10000)),
+            url_path="webhook",
+            webhook_url=f"https://{RENDER_EXTERNAL_HOSTNAME}/webhook",
+            secret_token=TG_SECRET
+        )